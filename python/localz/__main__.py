@@ -1,15 +1,14 @@
 import os
 import sys
+import json
 import time
-import errno
-import shutil
-import atexit
+import socket
 import logging
 import argparse
-import tempfile
 import traceback
 import contextlib
 import inspect
+import multiprocessing.pool
 
 from . import lib, version
 from . import _rezapi as rez
@@ -55,13 +54,115 @@ parser.add_argument("--paths", nargs="+", metavar="PATH", help=(
     "Override package search path"))
 parser.add_argument("-f", "--force", action="store_true", help=(
     "Copy package even if it isn't relocatable (use at your own risk)"))
+parser.add_argument("--staging-max-age", default=7, type=float,
+                    metavar="DAYS", help=(
+                        "Remove staged files of interrupted runs after "
+                        "this many days (default: %(default)s)"))
+parser.add_argument("--max-size", type=float, metavar="MB", help=(
+    "Exclude packages larger than this"))
+parser.add_argument("--deny", nargs="+", default=[], metavar="PATTERN", help=(
+    "Exclude packages whose name matches any of these, e.g. maya-2018*"))
+parser.add_argument("--stream", action="store_true", help=(
+    "Localize each package as soon as it is staged, rather than "
+    "staging everything up-front. Use this for many or large packages"))
+parser.add_argument("--max-staging", type=float, metavar="MB", help=(
+    "With --stream, stop staging ahead once this much is staged"))
 parser.add_argument("-v", "--verbose", default=0, action="count")
 parser.add_argument("--full", action="store_true", help=(
     "Localize requests and requirements of requests. "
     "Use this to create a fully localized context"))
+parser.add_argument("--verify", action="store_true", help=(
+    "Compare localized packages with their source, and record "
+    "the result for `localz verify` to compare against later"))
+parser.add_argument("--threads", default=8, type=int, help=(
+    "Number of packages to evaluate, or files to verify, "
+    "in parallel (default: %(default)s)"))
+parser.set_defaults(command="localize")
+
+verify_parser = argparse.ArgumentParser(
+    prog="localz verify",
+    description=(
+        "Verify that localized packages are identical to their "
+        "source. Packages verified before are compared against "
+        "what was recorded then, hashing only files modified since."
+    ))
+verify_parser.add_argument("request", nargs="*", metavar="PKG", help=(
+    "Packages to verify, defaults to every localized package"))
+verify_parser.add_argument("--prefix", metavar="PATH", help=(
+    "Verify localised packages here, instead of "
+    "REZ_LOCALIZED_PACKAGES_PATH"))
+verify_parser.add_argument("--paths", nargs="+", metavar="PATH", help=(
+    "Override package search path, for source packages"))
+verify_parser.add_argument("--threads", default=8, type=int, help=(
+    "Number of files to verify in parallel (default: %(default)s)"))
+verify_parser.add_argument("-v", "--verbose", default=0, action="count")
+verify_parser.set_defaults(command="verify")
+
+plan_parser = argparse.ArgumentParser(
+    prog="localz plan",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description=(
+        "Plan which packages to localize onto many hosts at once, and\n"
+        "optionally localize those planned for this host."
+    ),
+    epilog="""\
+examples:
+  Requests per host, as one or more sets of requests
+  $ cat requests.json
+  {
+    "render01": ["maya-2018", "arnold"],
+    "render02": [["maya-2018", "arnold"], ["nuke-12"]]
+  }
+
+  Write the plan to a file
+  $ rez env localz -- localize plan requests.json --output plan.json
+
+  Localize packages planned for this host, without resolving again
+  $ rez env localz -- localize plan plan.json --execute
+
+""")
+plan_parser.add_argument("file", metavar="FILE", help=(
+    "JSON file of requests per host, or a plan written by --output"))
+plan_parser.add_argument("-o", "--output", metavar="FILE", help=(
+    "Write plan to this file, rather than print it"))
+plan_parser.add_argument("--full", action="store_true", help=(
+    "Plan for requests and requirements of requests"))
+plan_parser.add_argument("--processes", type=int, help=(
+    "Number of requests to resolve in parallel (default: CPU count)"))
+plan_parser.add_argument("--execute", action="store_true", help=(
+    "Localize packages planned for this host"))
+plan_parser.add_argument("--host", default=socket.gethostname(), help=(
+    "Execute the plan of this host (default: %(default)s)"))
+plan_parser.add_argument("-j", "--jobs", default=4, type=int, help=(
+    "Number of packages to localize in parallel (default: %(default)s)"))
+plan_parser.add_argument("--prefix", metavar="PATH", help=(
+    "Write localised packages to here, instead of "
+    "REZ_LOCALIZED_PACKAGES_PATH"))
+plan_parser.add_argument("--paths", nargs="+", metavar="PATH", help=(
+    "Override package search path, when localizing with --execute. "
+    "Requests are always resolved with the configured search path"))
+plan_parser.add_argument("-f", "--force", action="store_true", help=(
+    "Copy package even if it isn't relocatable (use at your own risk)"))
+plan_parser.add_argument("-v", "--verbose", default=0, action="count")
+plan_parser.set_defaults(command="plan")
 
 
-opts = parser.parse_args()
+# Sub-commands are told apart from requests by their first argument
+if sys.argv[1:2] == ["verify"]:
+    opts = verify_parser.parse_args(sys.argv[2:])
+elif sys.argv[1:2] == ["plan"]:
+    opts = plan_parser.parse_args(sys.argv[2:])
+else:
+    opts = parser.parse_args()
+
+# Where results go, as opposed to progress
+output = sys.stdout
+
+# Keep a plan printed to standard output free of progress,
+# such that it may be redirected to a file and executed
+if opts.command == "plan" and not (opts.output or opts.execute):
+    sys.stdout = sys.stderr
+
 log = logging.getLogger(__name__)
 
 logginglevel = {
@@ -96,36 +197,226 @@ def abort(msg):
     exit(1)
 
 
-if opts.version:
+if opts.command == "localize" and opts.version:
     tell("localz-%s" % version)
     exit(0)
 
-if not opts.request:
+if opts.command == "localize" and not opts.request:
     parser.print_help()
     warn("At least one request is required")
     exit(1)
 
 
-def cleanup():
-    if not os.path.exists(tempdir):
-        return
+def verify():
+    location = opts.prefix or lib.localized_packages_path()
+    paths = opts.paths or rez.config.nonlocal_packages_path
+
+    if not os.path.isdir(location):
+        abort("Nothing has been localized to %s" % location)
+
+    requests = opts.request or sorted(
+        name for name in os.listdir(location)
+
+        # Bookkeeping, such as .localz
+        if not name.startswith(".")
+    )
+
+    variants = list()
+    with stage("Finding localized packages.."):
+        for request in requests:
+            request = rez.PackageRequest(request)
+            for pkg in rez.find(request.name,
+                                str(request.range) or None,
+                                paths=[location]):
+                variants += list(pkg.iter_variants())
+
+    tell("Verifying packages..")
+    failed = list()
+    for variant in variants:
+        tell("  %s.. " % variant.qualified_name, 0)
+
+        if os.path.exists(lib.manifest_path(variant, location)):
+            source = None
+
+        else:
+            # Never verified, compare with where it came from
+            source = lib.find_source(variant, location, paths)
+
+            if source is None:
+                tell("fail - no record or source to compare with")
+                failed += [variant]
+                continue
+
+        problems = lib.verify(variant, location, source, opts.threads)
+
+        if problems:
+            tell("fail")
+            failed += [variant]
+
+            for relpath, reason in problems:
+                tell("    %s (%s)" % (relpath, reason))
+
+        else:
+            tell("ok")
 
+    if failed:
+        tell("%d of %d packages failed verification"
+             % (len(failed), len(variants)))
+        return 1
+
+    tell("All %d packages verified" % len(variants))
+    return 0
+
+
+def plan():
+    with open(opts.file) as f:
+        data = json.load(f)
+
+    # A plan from a previous run need not be resolved again
+    if "variants" in data and isinstance(data.get("hosts"), dict):
+        planned = data
+
+    else:
+        with stage("Resolving requests of %d hosts.." % len(data)):
+            planned = lib.plan(data, opts.full, opts.processes)
+
+    for request, error in sorted(planned["errors"].items()):
+        warn("Could not resolve '%s': %s" % (request, error))
+
+    if not opts.output and not opts.execute:
+        output.write(json.dumps(planned, indent=2, sort_keys=True))
+        output.write("\n")
+        return 0
+
+    tell("%d packages, %.2f mb in total, planned for %d hosts"
+         % (len(planned["variants"]),
+            planned["size"] / (10.0 ** 6),
+            len(planned["hosts"])))
+
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(planned, f, indent=2, sort_keys=True)
+
+        tell("Plan written to %s" % opts.output)
+
+    if not opts.execute:
+        return 0
+
+    if opts.host not in planned["hosts"]:
+        abort("Nothing was planned for %s" % opts.host)
+
+    location = opts.prefix or lib.localized_packages_path()
+    paths = opts.paths or rez.config.nonlocal_packages_path
+
+    records = [
+        lib.Record(**planned["variants"][name])
+        for name in planned["hosts"][opts.host]["variants"]
+    ]
+
+    def transfer(record):
+        try:
+            copied = lib.transfer(record,
+                                  location,
+                                  paths,
+                                  opts.force,
+                                  opts.verbose)
+
+        except Exception as e:
+            return record, "fail - %s" % e
+
+        return record, "ok" if copied else "already localized"
+
+    tell("Localizing %d packages to %s.." % (len(records), location))
+
+    failed = list()
+    pool = multiprocessing.pool.ThreadPool(opts.jobs)
     try:
-        sys.stdout.write("Cleaning up temporary files.. ")
-        shutil.rmtree(tempdir)
-        sys.stdout.write("ok\n")
-    except OSError as e:
-        # It may already have been cleaned-up
-        if e.errno not in (errno.ENOENT, errno.EEXIST, errno.ENOTDIR):
-            sys.stdout.write("fail\n")
-            traceback.print_exc()
+        for record, status in pool.imap_unordered(transfer, records):
+            tell("  %s.. %s" % (record.qualified_name, status))
+
+            if status.startswith("fail"):
+                failed += [record]
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        tell("%d of %d packages failed to localize"
+             % (len(failed), len(records)))
+        return 1
 
+    tell("Success")
+    return 0
 
-def excepthook(type, value, traceback):
-    """Clean up temporary files"""
 
-    cleanup()
-    sys.__excepthook__(type, value, traceback)
+def stream(records):
+    max_staging = None
+    if opts.max_staging:
+        max_staging = int(opts.max_staging * 10 ** 6)
+
+    tell("Localizing..")
+    copied = 0
+    skipped = 0
+    size = 0
+    corrupt = list()
+
+    try:
+        for record, localized in lib.stream(records,
+                                            localized_packages_path,
+                                            opts.force,
+                                            opts.verbose,
+                                            max_staging):
+
+            if localized is None:
+                tell("  %s-%s  (already localized)"
+                     % (record.name, record.version))
+                skipped += 1
+                continue
+
+            tell("  %s-%s  %.2f mb" % (record.name,
+                                       record.version,
+                                       record.size / (10.0 ** 6)))
+            copied += 1
+            size += record.size
+
+            if not opts.verify:
+                continue
+
+            source = lib.find_record(record)
+
+            if source is None:
+                warn("No source to verify %s against"
+                     % record.qualified_name)
+                continue
+
+            problems = lib.verify(localized,
+                                  localized_packages_path,
+                                  source,
+                                  opts.threads)
+
+            for relpath, reason in problems:
+                tell("    %s (%s)" % (relpath, reason))
+
+            if problems:
+                corrupt += [record]
+
+    except Exception:
+        abort(traceback.format_exc())
+
+    tell("%d packages localized, %.2f mb, %d were already localized"
+         % (copied, size / (10.0 ** 6), skipped))
+
+    if corrupt:
+        tell("Some packages differ from their source, and may not "
+             "function as expected")
+
+        for record in corrupt:
+            tell("  %s" % record.qualified_name)
+
+        return 1
+
+    tell("Success")
+    return 0
 
 
 def ask(msg):
@@ -181,13 +472,13 @@ def stage(msg, count=0):
         tell("ok - %.2fs" % (time.time() - t0))
 
 
-# Keep it tidy
-tempdir = tempfile.mkdtemp()
-sys.excepthook = excepthook
-atexit.register(cleanup)
+tell("Using %s-%s" % (rez.project, rez.version))
 
+if opts.command == "verify":
+    exit(verify())
 
-tell("Using %s-%s" % (rez.project, rez.version))
+if opts.command == "plan":
+    exit(plan())
 
 # Find local packages path
 variants = list()
@@ -200,6 +491,12 @@ tell("Packages are discovered from these paths:")
 for path in nonlocal_packages_path:
     tell("  %s" % path, 1)
 
+# Staged files are kept on failure, for the next run to resume from.
+# Those never resumed are eventually collected here.
+for name in lib.collect_staging(localized_packages_path,
+                                opts.staging_max_age * 24 * 3600):
+    tell("Removed stale staging area for %s" % name)
+
 with stage("Resolving requested packages.."):
     try:
         variants = lib.resolve(opts.request,
@@ -207,87 +504,160 @@ with stage("Resolving requested packages.."):
                                opts.full)
 
     except Exception as e:
-        sys.stdout.write("\n")
+        sys.stdout.write("fail\n")
         abort(traceback.format_exc())
 
     except rez.PackageFamilyNotFoundError as e:
-        sys.stdout.write("\n")
+        sys.stdout.write("fail\n")
         abort(traceback.format_exc())
 
 
-count = len(variants)
-copied = list()
+approved = list()
 skipped = list()
-with stage("Preparing packages..", count) as bar:
-    for var in variants:
-
-        # Don't want to localise already-localised packages
-        if lib.exists(var, localized_packages_path):
-            skipped += [var.resource]
-            continue
-
-        copied += lib.prepare(var,
-                              tempdir,
-                              opts.all_variants,
-                              opts.force,
-                              opts.verbose)
-
-        bar.step()
+unrelocatable = list()
+excluded = list()
+with stage("Evaluating packages.."):
+    for status, record, reason in lib.policy(
+            variants,
+            localized_packages_path,
+            opts.all_variants,
+            opts.force,
+            opts.deny,
+            opts.threads):
+
+        if status == "localize":
+            approved += [record]
+
+        elif status == "localized":
+            skipped += [record]
+
+        elif status == "unrelocatable":
+            unrelocatable += [record]
 
+        else:
+            excluded += [(record, reason)]
 
-with stage("Determining relocatability.."):
-    unrelocatable = [var for var in copied if not lib.is_relocatable(var)]
-
+if skipped:
+    tell("The following packages were already available locally:")
+    for record in skipped:
+        tell("  %s-%s  (%s)" % (record.name, record.version, record.uri))
 
 if unrelocatable:
     tell("Some packages are unable to be relocated")
     tell("Use --force to forcibly relocate these, note that they may "
          "not function as expected.")
 
-    for variant in unrelocatable:
-        tell("  %s-%s" % (variant.name, variant.version))
+    for record in unrelocatable:
+        tell("  %s-%s" % (record.name, record.version))
 
-    shutil.rmtree(tempdir)
     exit(1)
 
+# Sizes are only worth walking the source for once the run may proceed
+if approved:
+    with stage("Measuring packages.."):
+        measured = lib.measure(
+            approved,
+            opts.max_size * 10 ** 6 if opts.max_size else None,
+            threads=opts.threads,
+        )
+
+        approved = list()
+        for status, record, reason in measured:
+            if status == "localize":
+                approved += [record]
+            else:
+                excluded += [(record, reason)]
+
+if excluded:
+    tell("The following packages were excluded:")
+    for record, reason in excluded:
+        tell("  %s-%s  (%s)" % (record.name, record.version, reason))
+
+if not approved and excluded:
+    tell("Nothing left to localize")
+    exit(0)
 
-if skipped:
-    tell("The following packages were already available locally:")
-    for variant in skipped:
-        tell("  %s-%s  (%s)" % (variant.name, variant.version, variant.uri))
-
-if not copied:
+if not approved:
     tell("All requested packages were already localized")
-    shutil.rmtree(tempdir)
     exit(0)
 
 tell("The following NEW packages will be localized:")
-for variant in copied:
-    tell("  %s-%s" % (variant.name, variant.version))
+for record in approved:
+    tell("  %s-%s" % (record.name, record.version))
 
-size = lib.dirsize(tempdir) / (10.0 ** 6)  # mb
+size = sum(record.size for record in approved)
+size /= 10.0 ** 6  # mb
 
 tell("After this operation, %.2f mb will be used" % size)
 
 if not opts.yes and not ask("Do you want to continue? [Y/n] "):
     tell("Cancelled")
-    shutil.rmtree(tempdir)
     exit(0)
 
+if opts.stream:
+    exit(stream(approved))
+
+count = len(approved)
+copied = list()
+with stage("Preparing packages..", count) as bar:
+    for record in approved:
+        variant = lib.find_record(record)
+
+        if variant is None:
+            raise ValueError("%s could no longer be found"
+                             % record.qualified_name)
+
+        copied += [(record, lib.stage(variant,
+                                      localized_packages_path,
+                                      opts.force,
+                                      opts.verbose))]
+
+        bar.step()
+
 # Report
 tell("Localizing..")
-for variant in copied:
+corrupt = list()
+for record, variant in copied:
     tell("  %s-%s" % (variant.name, variant.version))
     result = lib.localize(variant, localized_packages_path, opts.verbose)
 
     if result["skipped"]:
         print("These were already localized")
 
-tell("Success")
+    source = None
+    if opts.verify:
+        source = lib.find_record(record)
+
+        if source is None:
+            warn("No source to verify %s against"
+                 % variant.qualified_name)
+
+    if source is not None:
+        for _, localized in result["copied"] + result["skipped"]:
+            problems = lib.verify(localized,
+                                  localized_packages_path,
+                                  source,
+                                  opts.threads)
+
+            for relpath, reason in problems:
+                tell("    %s (%s)" % (relpath, reason))
+
+            if problems:
+                corrupt += [localized]
+
+    # Free up disk space as soon as possible
+    lib.unstage(variant, localized_packages_path)
 
-# Cleanup
-tell("Cleaning up temporary files..")
-shutil.rmtree(tempdir)
+if corrupt:
+    tell("Some packages differ from their source, and may not "
+         "function as expected")
+
+    for variant in corrupt:
+        tell("  %s" % variant.qualified_name)
+
+    exit(1)
+
+tell("Success")
 
 if localized_packages_path not in map(os.path.normpath,
                                       rez.config.packages_path):
@@ -2,6 +2,7 @@ from rez.resolved_context import ResolvedContext as env
 from rez.exceptions import PackageFamilyNotFoundError
 from rez.packages_ import iter_packages as find
 from rez.package_copy import copy_package
+from rez.package_repository import package_repository_manager
 from rez.packages_ import Package
 from rez.config import config
 from rez import __version__ as version
@@ -21,6 +22,7 @@ __all__ = [
     "version",
     "project",
     "copy_package",
+    "package_repository_manager",
     "Package",
     "PackageRequest",
     "PackageFamilyNotFoundError",
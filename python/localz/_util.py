@@ -0,0 +1,302 @@
+"""Building blocks independent of Rez"""
+
+import os
+import json
+import time
+import errno
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+class Lock(object):
+    """Cross-process lock, held on a file by the operating system
+
+    The operating system releases the lock once the process holding it
+    exits, crashed or otherwise, such that a lock is never left behind.
+    Separate instances exclude each other, even within one process.
+
+    Lock files are left in place once released, as removing them would
+    let another process lock a file about to be replaced by a new one.
+
+    """
+
+    def __init__(self, path, interval=0.1):
+        self._path = path
+        self._interval = interval
+        self._fd = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def acquire(self, blocking=True, timeout=None):
+        assert self._fd is None, "%s is already locked" % self._path
+
+        fd = os.open(self._path, os.O_CREAT | os.O_RDWR)
+
+        t0 = time.time()
+        while not _trylock(fd):
+            if not blocking or (
+                    timeout is not None and time.time() - t0 > timeout):
+                os.close(fd)
+                return False
+
+            time.sleep(self._interval)
+
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+
+        fd, self._fd = self._fd, None
+
+        try:
+            _unlock(fd)
+        finally:
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _trylock(fd):
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+
+    except (IOError, OSError):
+        return False
+
+    return True
+
+
+def _unlock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        # Another process may have gotten there first
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def iter_files(root, exclude=None):
+    """Yield path of each file under `root`, relative to `root`"""
+
+    exclude = exclude or set()
+
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        reldir = os.path.relpath(dirpath, root)
+
+        for fname in filenames:
+            if reldir == os.curdir and fname in exclude:
+                continue
+
+            yield os.path.normpath(os.path.join(reldir, fname))
+
+
+def copy_payload(src, dst, journal, exclude=None):
+    """Make `dst` a copy of `src`, skipping files already copied
+
+    Files the journal has recorded as copied from their source, as it is
+    now, are trusted as-is so long as they exist. Any other file already
+    at the destination is trusted only if it has the size and modification
+    time of its source, the latter only ever being written once all of its
+    content is, such that a file cut off half-way is copied again.
+
+    Files no longer in `src`, e.g. from an earlier version, are removed.
+
+    """
+
+    exclude = exclude or set()
+    relpaths = set()
+    reldirs = set()
+
+    for dirpath, dirnames, filenames in os.walk(src, followlinks=True):
+        reldir = os.path.normpath(os.path.relpath(dirpath, src))
+        reldirs.add(reldir)
+        makedirs(os.path.join(dst, reldir))
+
+        for fname in filenames:
+            if reldir == os.curdir and fname in exclude:
+                continue
+
+            relpath = os.path.normpath(os.path.join(reldir, fname))
+            relpaths.add(relpath)
+
+            stat = os.stat(os.path.join(src, relpath))
+            signature = [stat.st_size, int(stat.st_mtime)]
+
+            destination = os.path.join(dst, relpath)
+
+            if journal.get(relpath) == signature and _exists(destination):
+                continue
+
+            if not _is_same(destination, stat):
+                shutil.copy2(os.path.join(src, relpath), destination)
+
+            journal.add(relpath, signature)
+
+    for relpath in list(iter_files(dst, exclude)):
+        if relpath not in relpaths:
+            os.remove(os.path.join(dst, relpath))
+            journal.discard(relpath)
+
+    for dirpath, dirnames, filenames in os.walk(dst, topdown=False):
+        reldir = os.path.normpath(os.path.relpath(dirpath, dst))
+
+        if reldir not in reldirs and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+
+def _exists(path):
+    try:
+        os.lstat(path)
+    except OSError:
+        return False
+
+    return True
+
+
+def _is_same(path, stat):
+    try:
+        other = os.stat(path)
+    except OSError:
+        return False
+
+    return (
+        other.st_size == stat.st_size and
+
+        # Some filesystems only store modification time to the second
+        abs(other.st_mtime - stat.st_mtime) < 1
+    )
+
+
+class Journal(object):
+    """Append-only record of files copied, one JSON document per line
+
+    Files since removed are recorded without a signature.
+
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+
+        # Whether the last line was cut off, and needs terminating
+        self._dangling = False
+
+        try:
+            with open(path) as f:
+                for line in f:
+                    self._dangling = not line.endswith("\n")
+
+                    try:
+                        relpath, signature = json.loads(line)
+                    except ValueError:
+                        # Cut off half-way through being written
+                        continue
+
+                    if signature is None:
+                        self._entries.pop(relpath, None)
+                    else:
+                        self._entries[relpath] = signature
+
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def get(self, relpath):
+        return self._entries.get(relpath)
+
+    def add(self, relpath, signature):
+        self._entries[relpath] = signature
+        self._write(relpath, signature)
+
+    def discard(self, relpath):
+        if self._entries.pop(relpath, None) is not None:
+            self._write(relpath, None)
+
+    def _write(self, relpath, signature):
+        with open(self._path, "a") as f:
+            if self._dangling:
+                f.write("\n")
+                self._dangling = False
+
+            f.write(json.dumps([relpath, signature]) + "\n")
+
+
+class Budget(object):
+    """Number of bytes reserved, shared between threads
+
+    Reserving blocks until the reservation fits within `limit`. A single
+    reservation larger than the limit passes once nothing else is
+    reserved, rather than never.
+
+    """
+
+    def __init__(self, limit=None):
+        self._limit = limit
+        self._used = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @property
+    def used(self):
+        return self._used
+
+    def reserve(self, size):
+        """Reserve `size` bytes, returns False if closed whilst waiting"""
+
+        with self._condition:
+            while not self._closed and not self._fits(size):
+                self._condition.wait()
+
+            if self._closed:
+                return False
+
+            self._used += size
+            return True
+
+    def release(self, size):
+        with self._condition:
+            self._used -= size
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _fits(self, size):
+        if not self._limit or not self._used:
+            return True
+
+        return self._used + size <= self._limit
@@ -1,9 +1,32 @@
 import os
 import sys
+import json
+import time
+import errno
 import shutil
+import fnmatch
+import hashlib
 import itertools
+import threading
+import collections
+import multiprocessing
+import multiprocessing.pool
 
 from . import _rezapi as rez
+from ._util import (
+    Lock,
+    Budget,
+    Journal,
+    makedirs,
+    iter_files,
+    copy_payload,
+)
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
 
 
 def resolve(request, requires=None, full=False):
@@ -21,8 +44,6 @@ def resolve(request, requires=None, full=False):
     # Handle common errors here
     # The rest goes to the handler in stage()
     except rez.PackageFamilyNotFoundError as e:
-        sys.stdout.write("fail\n")
-
         # Ideally wouldn't have to parse the string-output of
         # this exception, but there isn't anything else we can do.
         try:
@@ -82,31 +103,265 @@ def exists(variant, location=None):
             return True
 
     # The variant is already localised
-    it = rez.find(variant.name,
-                  str(variant.version),
-                  paths=[location])
+    return find_localized(variant, location) is not None
+
+
+# Guards lookups of packages from repositories against their
+# caches being cleared, as lookups may happen in multiple threads
+_repository_lock = threading.RLock()
+
+
+def find_localized(variant, location=None):
+    """Return the localised equivalent of `variant`, or None"""
+
+    location = location or localized_packages_path()
+    return find_variant(variant, [location])
+
+
+def find_source(variant, location=None, paths=None):
+    """Return the variant `variant` was localised from, or None
+
+    Arguments:
+        variant (Variant): Localised variant
+        location (str): Where `variant` was localised to
+        paths (list): Package search paths, defaults to non-local ones
+
+    """
+
+    location = location or localized_packages_path()
+    location = os.path.normpath(os.path.abspath(location))
+    paths = paths or rez.config.nonlocal_packages_path
+
+    # Localised packages may well be on the search path,
+    # but would have `variant` be compared with itself
+    paths = [
+        path for path in paths
+        if os.path.normpath(os.path.abspath(path)) != location
+    ]
+
+    return find_variant(variant, paths)
+
+
+def find_variant(variant, paths):
+    """Return the equivalent of `variant` from `paths`, or None
+
+    Arguments:
+        variant (Variant or Record): Anything with a name, version and index
+        paths (list): Package search paths
+
+    """
+
+    # Caches may be cleared by another thread, see localize()
+    with _repository_lock:
+        it = rez.find(variant.name,
+                      str(variant.version),
+                      paths=paths)
+
+        # Multiple matches are possible
+        # E.g. mypackage-1.1.2, mypackage-1.1.2.beta
+        for pkg in it:
+            for var in pkg.iter_variants():
+                if var.name != variant.name:
+                    continue
+                if str(var.version) != str(variant.version):
+                    continue
+                if var.index != variant.index:
+                    continue
+                if rez.config.memcached_uri and not os.path.exists(var.root):
+                    continue
+
+                return var
+
+    return None
+
+
+class Record(collections.namedtuple("Record", [
+        "name", "version", "index", "uri", "size"])):
+    """Compact summary of a variant
+
+    Unlike variants, these are cheap to keep around in large
+    numbers and may be passed between processes.
+
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_variant(cls, variant, size=None):
+        return cls(variant.name,
+                   str(variant.version),
+                   variant.index,
+                   variant.uri,
+                   size)
+
+    @property
+    def qualified_name(self):
+        # Same as Variant.qualified_name
+        name = self.name
+
+        if self.version:
+            name = "%s-%s" % (name, self.version)
+
+        return "%s[%s]" % (name, "" if self.index is None else self.index)
+
+
+def plan(hosts, full=False, processes=None, threads=8):
+    """Compute which variants to localise onto each of `hosts`
+
+    Identical request sets are resolved only once, in parallel processes,
+    and the sizes of variants shared between hosts computed only once.
+
+    Arguments:
+        hosts (dict): Per host, a list of requests or list of such lists
+        full (bool): Include requirements of requests
+        processes (int): Number of resolves to run at once
+        threads (int): Number of variant sizes to compute at once
+
+    Returns:
+        dict: Of "variants" by qualified name, "hosts" with the variants
+            and their total size per host, overall "size" and any "errors"
+            by request.
+
+    """
+
+    requests = {}
+    for host, sets in hosts.items():
+        if sets and not isinstance(sets[0], (tuple, list)):
+            sets = [sets]
+
+        # Order of requests makes no difference to a resolve
+        requests[host] = sorted(set(tuple(sorted(s)) for s in sets))
+
+    unique = sorted(set(itertools.chain(*requests.values())))
+
+    args = [(request, full) for request in unique]
+    processes = min(processes or multiprocessing.cpu_count(), len(args))
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_resolve_records, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        # Not worth the overhead of another process
+        results = [_resolve_records(arg) for arg in args]
+
+    resolved = {}
+    errors = {}
+    roots = {}
+    for request, (records, error) in zip(unique, results):
+        if error:
+            errors[" ".join(request)] = error
+            continue
+
+        resolved[request] = [record for record, root in records]
+
+        for record, root in records:
+            roots[record.qualified_name] = root
+
+    names = sorted(roots)
+    sizes = _map(dirsize, [roots[name] for name in names], threads)
+    sizes = dict(zip(names, sizes))
+
+    variants = {}
+    for records in resolved.values():
+        for record in records:
+            size = sizes[record.qualified_name]
+            variants[record.qualified_name] = record._replace(size=size)
+
+    result = {
+        "variants": dict(
+            (name, dict(record._asdict()))
+            for name, record in variants.items()
+        ),
+        "hosts": {},
+        "size": sum(record.size for record in variants.values()),
+        "errors": errors,
+    }
+
+    for host, sets in requests.items():
+        names = set(
+            record.qualified_name
+            for request in sets
+            for record in resolved.get(request, [])
+        )
+
+        result["hosts"][host] = {
+            "variants": sorted(names),
+            "size": sum(variants[name].size for name in names),
+        }
+
+    return result
+
+
+def _resolve_records(args):
+    # Runs in a separate process, hence only passing
+    # around what is picklable, like records and strings
+    request, full = args
+
+    try:
+        variants = resolve(list(request), full=full)
+    except Exception as e:
+        return [], str(e) or e.__class__.__name__
+
+    return [
+        (Record.from_variant(variant), variant.root)
+        for variant in variants
+    ], None
+
+
+def find_record(record, paths=None):
+    """Return the variant summarised by `record`, or None
+
+    Arguments:
+        record (Record): Of a variant, as resolved
+        paths (list): Package search paths, defaults to those of Rez
+
+    """
+
+    paths = paths or rez.config.packages_path
 
-    existing = list(it)
+    with _repository_lock:
+        for pkg in rez.find(record.name, record.version, paths=paths):
+            for variant in pkg.iter_variants():
+                if variant.index != record.index:
+                    continue
+                if variant.uri != record.uri:
+                    continue
 
-    if not existing:
+                return variant
+
+    return None
+
+
+def transfer(record, location=None, paths=None, force=False, verbose=0):
+    """Localise the variant summarised by `record`
+
+    Returns:
+        bool: False if it was already localised
+
+    """
+
+    paths = paths or rez.config.nonlocal_packages_path
+    variant = find_variant(record, paths)
+
+    if variant is None:
+        raise ValueError("%s was not found" % record.qualified_name)
+
+    if exists(variant, location):
         return False
 
-    # Multiple matches are possible
-    # E.g. mypackage-1.1.2, mypackage-1.1.2.beta
-    for pkg in existing:
-        for var in pkg.iter_variants():
-            if var.name != variant.name:
-                continue
-            if var.version != variant.version:
-                continue
-            if var.index != variant.index:
-                continue
-            if rez.config.memcached_uri and not os.path.exists(variant.root):
-                continue
+    if not force and not is_relocatable(variant):
+        raise ValueError("%s is not relocatable" % record.qualified_name)
 
-            return True
+    staged = stage(variant, location, force, verbose)
+    result = localize(staged, location, verbose)
+    unstage(variant, location)
 
-    return False
+    return bool(result["copied"])
 
 
 def localized_packages_path():
@@ -124,42 +379,355 @@ def localized_packages_path():
     return path
 
 
-def prepare(variant,
-            tempdir,
-            all_variants=False,
-            force=False,
-            verbose=0):
+def policy(variants,
+           location=None,
+           all_variants=False,
+           force=False,
+           deny=None,
+           threads=8):
+    """Decide which of `variants` to localise, without copying anything
+
+    Only what is cheap to determine from the package definitions of
+    their source is considered, such that a run bound to fail does so
+    before any payload is looked at; see measure() for the rest.
 
-    result = rez.copy_package(
-        package=variant.parent,
+    Arguments:
+        variants (list): Resolved variants
+        location (str): Where variants are to be localised
+        all_variants (bool): Consider every variant of their packages
+        force (bool): Localise even unrelocatable variants
+        deny (list): Exclude variants whose name matches these patterns
+        threads (int): Number of variants to consider at once
 
-        # Copy only this one variant, unless explicitly overridden
-        variants=None if all_variants else [variant.index],
+    Yields:
+        tuple: Status of each variant, one of "localize", "localized",
+            "unrelocatable" or "excluded", a Record of it and, when
+            excluded, why.
 
-        dest_repository=tempdir,
-        shallow=False,
-        follow_symlinks=True,
+    """
 
-        # Make localized packages as similar
-        # to their original as possible
-        keep_timestamp=True,
+    def evaluate(variant):
+        status, reason = _evaluate(variant, location, force, deny)
+        return status, Record.from_variant(variant), reason
 
-        force=force,
+    variants = iter_variants(variants, all_variants)
+    return _imap(evaluate, variants, threads)
 
-        # Only for emergencies
-        verbose=verbose > 2,
-    )
 
-    copied = []
-    for source, destination in result["copied"]:
-        copied += [destination]
+def _evaluate(variant, location, force, deny):
+    if exists(variant, location):
+        return "localized", None
+
+    record = Record.from_variant(variant)
+    for pattern in deny or []:
+        if fnmatch.fnmatch(variant.name, pattern):
+            return "excluded", "denied by '%s'" % pattern
+
+        # E.g. maya-2018*
+        if fnmatch.fnmatch(record.qualified_name, pattern):
+            return "excluded", "denied by '%s'" % pattern
+
+    if not force and not is_relocatable(variant):
+        return "unrelocatable", None
+
+    return "localize", None
+
+
+def measure(records, max_size=None, paths=None, threads=8):
+    """Determine the size of each of `records`, from their source
+
+    Only file sizes are read, none of their content.
+
+    Arguments:
+        records (list): Of variants to localise
+        max_size (int): Exclude variants larger than this many bytes
+        paths (list): Package search paths, defaults to those of Rez
+        threads (int): Number of variants to measure at once
+
+    Yields:
+        tuple: Status of each variant, either "localize" or "excluded",
+            its Record along with its size and, when excluded, why.
+
+    """
+
+    def evaluate(record):
+        variant = find_record(record, paths)
+
+        if variant is None:
+            raise ValueError("%s could no longer be found"
+                             % record.qualified_name)
+
+        record = record._replace(size=dirsize(variant.root))
+
+        if max_size is not None and record.size > max_size:
+            reason = "larger than %.2f mb" % (max_size / (10.0 ** 6))
+            return "excluded", record, reason
+
+        return "localize", record, None
+
+    return _imap(evaluate, records, threads)
+
+
+def _imap(func, iterable, threads):
+    """Like _map(), but lazily, in batches"""
+
+    iterable = iter(iterable)
+    pool = multiprocessing.pool.ThreadPool(threads)
+
+    try:
+        # Such that only so many items are held at once
+        while True:
+            batch = list(itertools.islice(iterable, threads * 4))
+
+            if not batch:
+                break
+
+            for result in pool.map(func, batch):
+                yield result
+
+    finally:
+        pool.close()
+        pool.join()
+
+
+def iter_variants(variants, all_variants=False):
+    """Yield each of `variants`, or every variant of their packages"""
+
+    for variant in variants:
+        if all_variants:
+            for var in variant.parent.iter_variants():
+                yield var
+        else:
+            yield variant
+
+
+def stream(records,
+           location=None,
+           force=False,
+           verbose=0,
+           max_staging=None,
+           paths=None):
+    """Localise variants of `records` one at a time, as they are staged
+
+    The next variant is staged whilst the previous one is localised,
+    so long as no more than `max_staging` bytes are staged at once, and
+    each staging area is removed as soon as it has been localised.
+
+    Variants are found again from `paths` only once their turn comes,
+    such that only their records are held meanwhile.
+
+    Yields:
+        tuple: Record of each variant, and its localised equivalent,
+            or None if it was already localised.
+
+    """
+
+    budget = Budget(max_staging)
+    staged = queue.Queue(maxsize=1)
+    stopping = threading.Event()
+    errors = []
+
+    def handover(item):
+        while not stopping.is_set():
+            try:
+                staged.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            else:
+                break
+
+    def produce():
+        try:
+            for record in records:
+                variant = find_record(record, paths)
+
+                if variant is None:
+                    raise ValueError("%s could no longer be found"
+                                     % record.qualified_name)
+
+                if exists(variant, location):
+                    handover((record, None))
+                    continue
+
+                size = record.size
+
+                if size is None:
+                    # Only file sizes are read, none of their content
+                    size = dirsize(variant.root)
+                    record = record._replace(size=size)
+
+                if not budget.reserve(size):
+                    return
+
+                destination = stage(variant, location, force, verbose)
+                handover((record, destination))
+
+        except Exception as e:
+            errors.append(e)
+
+        handover(None)
 
-    # As we're copying into a staging area, there isn't any
-    # risk of packages getting skipped. However make it assert,
-    # to ensure it doesn't proceed under false pretenses.
-    assert not result["skipped"], (tempdir, result["skipped"])
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
 
-    return copied
+    try:
+        while True:
+            item = staged.get()
+
+            if item is None:
+                break
+
+            record, destination = item
+
+            if destination is None:
+                yield record, None
+                continue
+
+            try:
+                result = localize(destination, location, verbose)
+            finally:
+                budget.release(record.size)
+
+            # Kept on failure, for the next run to resume from
+            unstage(destination, location)
+
+            localized = result["copied"] + result["skipped"]
+            yield record, localized[0][1]
+
+    finally:
+        # Let the producer go, whatever it is doing
+        stopping.set()
+        budget.close()
+
+    if errors:
+        raise errors[0]
+
+
+def staging_path(variant, location=None):
+    return os.path.join(metadir(location, "staging"), variant.qualified_name)
+
+
+def stage(variant, location=None, force=False, verbose=0):
+    """Copy `variant` into its staging area, resuming any previous attempt
+
+    The payload is copied one file at a time, each completed file being
+    recorded in a journal. The package definition is written last, and
+    is what tells a completely staged variant apart from a partial one.
+
+    Should another process have localised `variant` in the meantime,
+    nothing is copied and its localised equivalent is returned instead.
+
+    """
+
+    root = staging_path(variant, location)
+
+    with Lock(root + ".lock"):
+        existing = _refind_localized(variant, location)
+
+        if existing is not None:
+            return existing
+
+        makedirs(root)
+        journal = Journal(os.path.join(root, ".journal"))
+
+        payload = os.path.join(root,
+                               variant.name,
+                               str(variant.version),
+                               variant.subpath or "")
+
+        # Without variants, the payload sits next to the package
+        # definition, which is written by Rez rather than copied
+        exclude = set() if variant.subpath else set(package_filenames)
+
+        copy_payload(variant.root, payload, journal, exclude)
+
+        result = rez.copy_package(
+            package=variant.parent,
+            variants=[variant.index],
+            dest_repository=root,
+
+            # The payload is copied above
+            skip_payload=True,
+
+            # Make localized packages as similar
+            # to their original as possible
+            keep_timestamp=True,
+
+            force=force,
+
+            # Only for emergencies
+            verbose=verbose > 2,
+        )
+
+    # Skipped variants were staged in full by a previous run
+    staged = result["copied"] + result["skipped"]
+    assert staged, (root, variant.qualified_name)
+
+    source, destination = staged[0]
+    return destination
+
+
+def unstage(variant, location=None):
+    """Remove the staging area of `variant`"""
+
+    root = staging_path(variant, location)
+
+    with Lock(root + ".lock"):
+        _remove_staging(root)
+
+
+def _remove_staging(root):
+    # The journal goes first, such that a removal cut short
+    # doesn't leave it vouching for files no longer there
+    try:
+        os.remove(os.path.join(root, ".journal"))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    if os.path.exists(root):
+        shutil.rmtree(root)
+
+
+def collect_staging(location=None, max_age=7 * 24 * 3600):
+    """Remove staging areas untouched for `max_age` seconds
+
+    Staging areas currently in use by another process are left alone.
+
+    """
+
+    dirname = metadir(location, "staging")
+    collected = []
+
+    for name in os.listdir(dirname):
+        root = os.path.join(dirname, name)
+
+        if not os.path.isdir(root):
+            continue
+
+        journal = os.path.join(root, ".journal")
+        mtime = os.path.getmtime(
+            journal if os.path.exists(journal) else root
+        )
+
+        if time.time() - mtime < max_age:
+            continue
+
+        lock = Lock(root + ".lock")
+        if not lock.acquire(blocking=False):
+            continue
+
+        try:
+            _remove_staging(root)
+            collected += [name]
+        finally:
+            lock.release()
+
+    return collected
+
+
+package_filenames = ("package.py", "package.yaml", "package.txt")
 
 
 class Animation(object):
@@ -193,20 +761,48 @@ class Animation(object):
 
 def localize(variant, path=None, verbose=0):
     path = path or localized_packages_path()
-    pkg = rez.Package(variant.parent)
-    result = rez.copy_package(
-        package=pkg,
-        dest_repository=path,
-        shallow=False,
-        follow_symlinks=True,
-        keep_timestamp=True,
-        force=True,
-        verbose=verbose > 2,
-    )
+
+    # Another process may be localising this very variant, in which
+    # case we wait for it to finish and reuse what it copied.
+    with lock(variant, path):
+
+        existing = _refind_localized(variant, path)
+
+        if existing is not None:
+            return {"copied": [], "skipped": [(variant, existing)]}
+
+        pkg = rez.Package(variant.parent)
+        result = rez.copy_package(
+            package=pkg,
+
+            # Siblings are localised under their own lock
+            variants=[variant.index],
+
+            dest_repository=path,
+            shallow=False,
+            follow_symlinks=True,
+            keep_timestamp=True,
+            force=True,
+            verbose=verbose > 2,
+        )
 
     return result
 
 
+def _refind_localized(variant, location=None):
+    """Like find_localized(), but for changes made by other processes"""
+
+    location = location or localized_packages_path()
+
+    with _repository_lock:
+        # Packages seen prior to this call may be out of date,
+        # but only clear those of this one repository.
+        repository = rez.package_repository_manager.get_repository(location)
+        repository.clear_caches()
+
+        return find_localized(variant, location)
+
+
 def delocalize(variant, path=None, verbose=0):
     if variant.resource.repository_type != "filesystem":
         raise TypeError(
@@ -217,6 +813,10 @@ def delocalize(variant, path=None, verbose=0):
     path = path or localized_packages_path()
     shutil.rmtree(variant.root)
 
+    manifest = manifest_path(variant, path)
+    if os.path.exists(manifest):
+        os.remove(manifest)
+
 
 def is_relocatable(pkg):
     if pkg.relocatable is None:
@@ -231,3 +831,155 @@ def dirsize(path):
         for dirpath, dirnames, filenames in os.walk(path)
         for filename in filenames
     )
+
+
+def manifest_path(variant, location=None):
+    dirname = metadir(location, "manifests")
+    return os.path.join(dirname, "%s.json" % variant.qualified_name)
+
+
+def verify(variant, location=None, source=None, threads=8):
+    """Compare files of localised `variant` with what they should be
+
+    With a `source`, every file of both is hashed and compared, and
+    the result recorded in a manifest. Without, files are compared
+    against that manifest, and only those whose size or modification
+    time have changed since are hashed again.
+
+    Returns a list of (relpath, reason) for files that differ.
+
+    """
+
+    fname = manifest_path(variant, location)
+    exclude = set() if variant.subpath else set(package_filenames)
+
+    if source is not None:
+        relpaths = set(iter_files(source.root, exclude))
+        relpaths.update(iter_files(variant.root, exclude))
+        relpaths = sorted(relpaths)
+
+        tasks = [
+            (os.path.join(source.root, relpath),
+             os.path.join(variant.root, relpath))
+            for relpath in relpaths
+        ]
+
+        problems = []
+        manifest = {}
+        for relpath, (expected, actual) in zip(
+                relpaths, _map(_hash_pair, tasks, threads)):
+
+            if expected is None:
+                problems += [(relpath, "not in source")]
+
+            elif actual is None:
+                problems += [(relpath, "missing")]
+
+            elif expected != actual:
+                problems += [(relpath, "differs from source")]
+
+            else:
+                stat = os.stat(os.path.join(variant.root, relpath))
+                manifest[relpath] = [stat.st_size, stat.st_mtime, actual]
+
+        if not problems:
+            with open(fname, "w") as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+
+        return problems
+
+    try:
+        with open(fname) as f:
+            manifest = json.load(f)
+
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+        raise ValueError(
+            "%s has no manifest, verify it against "
+            "its source first" % variant.qualified_name
+        )
+
+    problems = []
+    changed = []
+    for relpath, (size, mtime, digest) in sorted(manifest.items()):
+        try:
+            stat = os.stat(os.path.join(variant.root, relpath))
+        except OSError:
+            problems += [(relpath, "missing")]
+            continue
+
+        if stat.st_size == size and stat.st_mtime == mtime:
+            continue
+
+        changed += [(relpath, digest)]
+
+    tasks = [os.path.join(variant.root, relpath) for relpath, _ in changed]
+    for (relpath, expected), actual in zip(
+            changed, _map(hash_file, tasks, threads)):
+
+        if expected != actual:
+            problems += [(relpath, "modified")]
+
+    return problems
+
+
+def hash_file(path, chunksize=2 ** 20):
+    """Return hex digest of the content of `path`, or None if missing"""
+
+    digest = hashlib.sha256()
+
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunksize), b""):
+                digest.update(chunk)
+
+    except IOError as e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+
+        return None
+
+    return digest.hexdigest()
+
+
+def _hash_pair(paths):
+    # With many of these in flight, source and destination are read
+    # at the same time, which typically reside on different devices
+    src, dst = paths
+    return hash_file(src), hash_file(dst)
+
+
+def _map(func, iterable, threads):
+    """Like map(), in parallel threads, preserving order"""
+
+    pool = multiprocessing.pool.ThreadPool(threads)
+
+    try:
+        return pool.map(func, iterable)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def metadir(location=None, *parts):
+    """Return directory of bookkeeping files for localz within `location`
+
+    Rez only considers valid package names for families, which
+    is why this leading dot keeps it out of any resolve.
+
+    """
+
+    location = location or localized_packages_path()
+    path = os.path.join(location, ".localz", *parts)
+    makedirs(path)
+    return path
+
+
+def lock(variant, location=None, **kwargs):
+    """Return a cross-process lock for localising `variant` to `location`"""
+
+    dirname = metadir(location, "locks")
+    fname = os.path.join(dirname, "%s.lock" % variant.qualified_name)
+    return Lock(fname, **kwargs)
@@ -0,0 +1,220 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "python"))
+
+from localz import _util  # noqa: E402
+
+
+def _hold(path, events, duration):
+    with _util.Lock(path):
+        with open(events, "a") as f:
+            f.write("enter\n")
+        time.sleep(duration)
+        with open(events, "a") as f:
+            f.write("exit\n")
+
+
+def test_lock_excludes_other_instances():
+    path = os.path.join(tempfile.mkdtemp(), "a.lock")
+    first, second = _util.Lock(path), _util.Lock(path)
+
+    assert first.acquire(blocking=False)
+    assert not second.acquire(blocking=False)
+    assert not second.acquire(timeout=0.2)
+
+    first.release()
+    assert second.acquire(blocking=False)
+    second.release()
+
+
+def test_lock_excludes_contending_processes():
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, "a.lock")
+    events = os.path.join(tempdir, "events")
+
+    processes = [
+        multiprocessing.Process(target=_hold, args=(path, events, 0.2))
+        for _ in range(4)
+    ]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    with open(events) as f:
+        assert f.read().split() == ["enter", "exit"] * 4
+
+
+def test_lock_released_when_owner_dies():
+    path = os.path.join(tempfile.mkdtemp(), "a.lock")
+
+    # Acquire, and exit without ever releasing
+    script = (
+        "import sys, os\n"
+        "sys.path.insert(0, %r)\n"
+        "from localz import _util\n"
+        "_util.Lock(%r).acquire()\n"
+        "sys.stdout.write('locked\\n')\n"
+        "sys.stdout.flush()\n"
+        "sys.stdin.readline()\n"
+        "os._exit(1)\n"
+    ) % (os.path.join(os.path.dirname(_util.__file__), os.pardir), path)
+
+    owner = subprocess.Popen([sys.executable, "-c", script],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+    assert owner.stdout.readline().strip() == b"locked"
+
+    lock = _util.Lock(path)
+    assert not lock.acquire(blocking=False)
+
+    owner.communicate(b"\n")
+    assert lock.acquire(timeout=5)
+    lock.release()
+
+
+def _write(path, content):
+    _util.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _payload():
+    tempdir = tempfile.mkdtemp()
+    src = os.path.join(tempdir, "src")
+    dst = os.path.join(tempdir, "dst")
+
+    _write(os.path.join(src, "package.py"), "name = 'a'")
+    _write(os.path.join(src, "bin", "app"), "app" * 1000)
+    _write(os.path.join(src, "lib", "a.py"), "a")
+
+    return src, dst, os.path.join(tempdir, "journal")
+
+
+def test_copy_payload():
+    src, dst, journal = _payload()
+    _util.copy_payload(src, dst, _util.Journal(journal), {"package.py"})
+
+    assert sorted(_util.iter_files(dst)) == [
+        os.path.join("bin", "app"),
+        os.path.join("lib", "a.py"),
+    ]
+    assert _read(os.path.join(dst, "bin", "app")) == "app" * 1000
+
+
+def test_copy_payload_resumes_partial_file():
+    src, dst, journal = _payload()
+    _util.copy_payload(src, dst, _util.Journal(journal))
+
+    # Interrupted half-way through copying, before it was journalled
+    lines = _read(journal).splitlines()
+    with open(journal, "w") as f:
+        f.write("\n".join(
+            line for line in lines if "app" not in line
+        ) + "\n" + '["trunc')
+
+    _write(os.path.join(dst, "bin", "app"), "app")
+
+    _util.copy_payload(src, dst, _util.Journal(journal))
+    assert _read(os.path.join(dst, "bin", "app")) == "app" * 1000
+
+
+def test_copy_payload_trusts_journal():
+    src, dst, journal = _payload()
+    _util.copy_payload(src, dst, _util.Journal(journal))
+
+    # Journalled files are not looked at again
+    _write(os.path.join(dst, "lib", "a.py"), "modified")
+    _util.copy_payload(src, dst, _util.Journal(journal))
+
+    assert _read(os.path.join(dst, "lib", "a.py")) == "modified"
+
+
+def test_copy_payload_removes_files_gone_from_source():
+    src, dst, journal = _payload()
+    _util.copy_payload(src, dst, _util.Journal(journal))
+
+    os.remove(os.path.join(src, "lib", "a.py"))
+    os.rmdir(os.path.join(src, "lib"))
+    _util.copy_payload(src, dst, _util.Journal(journal))
+
+    assert not os.path.exists(os.path.join(dst, "lib"))
+    assert _util.Journal(journal).get(os.path.join("lib", "a.py")) is None
+
+    # Restored, and copied again
+    _write(os.path.join(src, "lib", "a.py"), "a")
+    _util.copy_payload(src, dst, _util.Journal(journal))
+
+    assert _read(os.path.join(dst, "lib", "a.py")) == "a"
+
+
+def _reserve_later(budget, size, results):
+    thread = threading.Thread(
+        target=lambda: results.append(budget.reserve(size)))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_budget_blocks_until_reservation_fits():
+    budget = _util.Budget(100)
+    assert budget.reserve(60)
+
+    results = []
+    thread = _reserve_later(budget, 60, results)
+    thread.join(0.2)
+    assert results == []
+
+    budget.release(60)
+    thread.join(1)
+    assert results == [True]
+    assert budget.used == 60
+
+
+def test_budget_passes_oversized_reservation_alone():
+    budget = _util.Budget(100)
+    assert budget.reserve(500)
+
+    results = []
+    thread = _reserve_later(budget, 1, results)
+    thread.join(0.2)
+    assert results == []
+
+    budget.release(500)
+    thread.join(1)
+    assert results == [True]
+
+
+def test_budget_close_releases_waiters():
+    budget = _util.Budget(100)
+    assert budget.reserve(100)
+
+    results = []
+    thread = _reserve_later(budget, 1, results)
+    budget.close()
+    thread.join(1)
+    assert results == [False]
+
+
+def test_copy_payload_restores_journalled_file():
+    src, dst, journal = _payload()
+    _util.copy_payload(src, dst, _util.Journal(journal))
+
+    # E.g. from a removal of the staging area cut short
+    os.remove(os.path.join(dst, "lib", "a.py"))
+    _util.copy_payload(src, dst, _util.Journal(journal))
+
+    assert _read(os.path.join(dst, "lib", "a.py")) == "a"